@@ -3,7 +3,9 @@
 
 import sys
 import os
+import io
 import re
+import functools
 
 # ---------------------------------------------------------------------------
 # Instruction encoding tables
@@ -62,17 +64,22 @@ FIXED_OPCODES = {
 }
 
 # Instructions that take no operand byte at all.
-NO_OPERAND = {"RET", "PUSH A", "PUSH R0", "PUSH R1",
-              "POP A", "POP R0", "POP R1",
-              "INC A", "INC R0", "INC R1",
-              "DEC A", "DEC R0", "DEC R1",
-              "NOP", "HLT"}
+NO_OPERAND = frozenset({"RET", "PUSH A", "PUSH R0", "PUSH R1",
+                        "POP A", "POP R0", "POP R1",
+                        "INC A", "INC R0", "INC R1",
+                        "DEC A", "DEC R0", "DEC R1",
+                        "NOP", "HLT"})
+
+# Compound fixed instructions (mnemonic + register operand), keyed by the
+# (mnemonic, register) pair and mapping to their FIXED_OPCODES key, e.g.
+# ("PUSH", "A") -> "PUSH A".
+COMPOUND_FIXED = {tuple(k.split()): k for k in FIXED_OPCODES if " " in k}
 
 # Branch instructions (need signed displacement).
-BRANCH_INSTRUCTIONS = {"BZ", "BNZ", "BC", "BNC"}
+BRANCH_INSTRUCTIONS = frozenset({"BZ", "BNZ", "BC", "BNC"})
 
 # Register names (for detection).
-REGISTER_NAMES = {"A", "R0", "R1"}
+REGISTER_NAMES = frozenset({"A", "R0", "R1"})
 
 # ---------------------------------------------------------------------------
 # Number parsing
@@ -87,8 +94,14 @@ ESCAPE_MAP = {
 }
 
 
+@functools.lru_cache(maxsize=1024)
 def decode_string(s):
-    """Decode escape sequences in a string, return list of byte values."""
+    """Decode escape sequences in a string. Returns (bytes, error).
+
+    error is None on success; otherwise bytes is None and error is the
+    message. Cached, since the same message text is often declared more
+    than once and each .DS string is decoded in both passes.
+    """
     result = []
     i = 0
     while i < len(s):
@@ -98,13 +111,13 @@ def decode_string(s):
                 result.append(ESCAPE_MAP[ch])
                 i += 2
                 continue
-            raise ValueError(f"Unknown escape sequence '\\{ch}'")
+            return (None, f"Unknown escape sequence '\\{ch}'")
         if ord(s[i]) > 0x7F:
-            raise ValueError(
-                f"Non-ASCII character '{s[i]}' (0x{ord(s[i]):02X})")
+            return (None,
+                    f"Non-ASCII character '{s[i]}' (0x{ord(s[i]):02X})")
         result.append(ord(s[i]))
         i += 1
-    return result
+    return (bytes(result), None)
 
 
 def parse_number(s, symbols=None):
@@ -112,10 +125,16 @@ def parse_number(s, symbols=None):
     s = s.strip()
     if symbols and s in symbols:
         return symbols[s]
-    if s.startswith("0x") or s.startswith("0X"):
+    prefix = s[:2]
+    if prefix == "0x" or prefix == "0X":
         return int(s, 16)
-    if s.startswith("0b") or s.startswith("0B"):
+    if prefix == "0b" or prefix == "0B":
         return int(s, 2)
+    # Only text starting with a digit (after an optional sign) can be a
+    # decimal literal; symbol names return here without raising.
+    digits = s[1:] if s[:1] in ("+", "-") else s
+    if not digits[:1].isdecimal():
+        return None
     try:
         return int(s)
     except ValueError:
@@ -125,70 +144,59 @@ def parse_number(s, symbols=None):
 # Operand parsing
 # ---------------------------------------------------------------------------
 
-# Regex for indexed addressing: [R0+5], [R1+0x10], [R0], [R1]
-RE_INDEXED = re.compile(
-    r"^\[\s*(R[01])\s*(?:\+\s*(.+?))?\s*\]$", re.IGNORECASE)
-
-# Regex for direct addressing: [addr] or [symbol]
-RE_DIRECT = re.compile(r"^\[\s*(.+?)\s*\]$")
-
-# Regex for immediate: #value or #symbol
-RE_IMMEDIATE = re.compile(r"^#\s*(.+)$")
-
-
-def parse_operand(text, symbols=None):
-    """Parse an operand string and return (mode, reg_name, value).
-
-    mode:     "imm", "reg", "direct", "indexed", "value"
-    reg_name: register name for register/indexed modes, None otherwise
-    value:    integer or symbol name (string) if not yet resolved
+# Regex for all operand forms, tried in this order:
+#   register:  A, R0, R1
+#   indexed:   [R0+5], [R1+0x10], [R0], [R1]
+#   direct:    [addr] or [symbol]
+#   immediate: #value or #symbol
+# Anything else is a bare symbol or number.
+RE_OPERAND = re.compile(
+    r"^(?:(?P<reg>A|R[01])"
+    r"|\[\s*(?P<idxreg>R[01])\s*(?:\+\s*(?P<idxoff>.+?))?\s*\]"
+    r"|\[\s*(?P<direct>.+?)\s*\]"
+    r"|#\s*(?P<imm>.+))$", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_operand_shape(text):
+    """Parse the symbol-independent shape of an operand string.
+
+    Returns (mode, reg_name, value_text): value_text is the literal or
+    symbol text still to be resolved, or None when the operand has no
+    value (register mode, or indexed mode without an offset). The result
+    depends only on the text, so it is cached. value_text is interned so
+    symbol-table lookups on it hit the identity fast path.
     """
     text = text.strip()
+    m = RE_OPERAND.match(text)
 
-    # Register mode: A, R0, R1
-    upper = text.upper()
-    if upper in REGISTER_NAMES:
-        return ("reg", upper, None)
-
+    # Bare symbol or number (used by JMP, CALL, branches)
+    if m is None:
+        return ("value", None, sys.intern(text))
+
+    kind = m.lastgroup
+    if kind == "reg":
+        return ("reg", text.upper(), None)
+    if kind == "direct":
+        return ("direct", None, sys.intern(m.group("direct")))
+    if kind == "imm":
+        return ("imm", None, sys.intern(m.group("imm")))
     # Indexed: [Rn+offset] or [Rn]
-    m = RE_INDEXED.match(text)
-    if m:
-        reg = m.group(1).upper()
-        if m.group(2) is not None:
-            val = parse_number(m.group(2), symbols)
-            if val is None:
-                return ("indexed", reg, m.group(2))  # unresolved symbol
-            return ("indexed", reg, val)
-        return ("indexed", reg, 0)
-
-    # Direct: [addr]
-    m = RE_DIRECT.match(text)
-    if m:
-        val = parse_number(m.group(1), symbols)
-        if val is None:
-            return ("direct", None, m.group(1))  # unresolved symbol
-        return ("direct", None, val)
+    offset = m.group("idxoff")
+    if offset is not None:
+        offset = sys.intern(offset)
+    return ("indexed", m.group("idxreg").upper(), offset)
 
-    # Immediate: #value
-    m = RE_IMMEDIATE.match(text)
-    if m:
-        val = parse_number(m.group(1), symbols)
-        if val is None:
-            return ("imm", None, m.group(1))  # unresolved symbol
-        return ("imm", None, val)
-
-    # Bare symbol or number (used by JMP, CALL, branches)
-    val = parse_number(text, symbols)
-    if val is not None:
-        return ("value", None, val)
-    return ("value", None, text)  # unresolved symbol
 
 # ---------------------------------------------------------------------------
 # Encoding functions
 # ---------------------------------------------------------------------------
 
 def encode_ld_st(is_store, primary_reg, mode, other_reg, value):
-    """Encode an LD or ST instruction. Returns (opcode, operand|None).
+    """Encode an LD or ST instruction.
+
+    Returns (opcode, operand|None, None), or (None, None, error) if the
+    operand combination is invalid.
 
     is_store:    True for ST, False for LD
     primary_reg: "A", "R0", or "R1"
@@ -200,36 +208,40 @@ def encode_ld_st(is_store, primary_reg, mode, other_reg, value):
 
     if mode == "imm":
         if is_store:
-            raise ValueError("ST does not support immediate addressing mode")
+            return (None, None,
+                    "ST does not support immediate addressing mode")
         opcode = (iiiii << 3) | 0b000  # R=0, MM=00
-        return (opcode, value & 0xFF)
+        return (opcode, value & 0xFF, None)
 
     elif mode == "reg":
         key = (primary_reg, other_reg)
         if key not in REG_MODE_R_BIT:
             kind = "ST" if is_store else "LD"
-            raise ValueError(
-                f"Cannot use {other_reg} with {kind} {primary_reg} "
-                f"in register mode")
+            return (None, None,
+                    f"Cannot use {other_reg} with {kind} {primary_reg} "
+                    f"in register mode")
         r_bit = REG_MODE_R_BIT[key]
         opcode = (iiiii << 3) | (r_bit << 2) | 0b01  # MM=01
-        return (opcode, None)
+        return (opcode, None, None)
 
     elif mode == "direct":
         opcode = (iiiii << 3) | 0b010  # R=0, MM=10
-        return (opcode, value & 0xFF)
+        return (opcode, value & 0xFF, None)
 
     elif mode == "indexed":
         r_bit = 0 if other_reg == "R0" else 1
         opcode = (iiiii << 3) | (r_bit << 2) | 0b11  # MM=11
-        return (opcode, value & 0xFF)
+        return (opcode, value & 0xFF, None)
 
     else:
-        raise ValueError(f"Invalid addressing mode '{mode}'")
+        return (None, None, f"Invalid addressing mode '{mode}'")
 
 
 def encode_alu(mnemonic, mode, reg, value):
-    """Encode an ALU instruction. Returns (opcode, operand|None).
+    """Encode an ALU instruction.
+
+    Returns (opcode, operand|None, None), or (None, None, error) if the
+    operand combination is invalid.
 
     For ALU ops, A is always the implicit accumulator.
     In register mode, only R0 and R1 are valid sources.
@@ -238,66 +250,66 @@ def encode_alu(mnemonic, mode, reg, value):
 
     if mode == "imm":
         opcode = (iiiii << 3) | 0b000  # R=0, MM=00
-        return (opcode, value & 0xFF)
+        return (opcode, value & 0xFF, None)
 
     elif mode == "reg":
         if reg not in ("R0", "R1"):
-            raise ValueError(
-                f"{mnemonic} only accepts R0 or R1 in register mode, "
-                f"not {reg}")
+            return (None, None,
+                    f"{mnemonic} only accepts R0 or R1 in register mode, "
+                    f"not {reg}")
         r_bit = 0 if reg == "R0" else 1
         opcode = (iiiii << 3) | (r_bit << 2) | 0b01  # MM=01
-        return (opcode, None)
+        return (opcode, None, None)
 
     elif mode == "direct":
         opcode = (iiiii << 3) | 0b010  # R=0, MM=10
-        return (opcode, value & 0xFF)
+        return (opcode, value & 0xFF, None)
 
     elif mode == "indexed":
         r_bit = 0 if reg == "R0" else 1
         opcode = (iiiii << 3) | (r_bit << 2) | 0b11  # MM=11
-        return (opcode, value & 0xFF)
+        return (opcode, value & 0xFF, None)
 
     else:
-        raise ValueError(f"Invalid addressing mode '{mode}' for {mnemonic}")
+        return (None, None,
+                f"Invalid addressing mode '{mode}' for {mnemonic}")
 
 # ---------------------------------------------------------------------------
 # Line parsing
 # ---------------------------------------------------------------------------
 
-def strip_comment(line):
-    """Remove comment from line, respecting that ; starts a comment."""
-    idx = line.find(";")
-    if idx >= 0:
-        return line[:idx]
-    return line
+# Regex for a leading label: "name:"
+RE_LABEL = re.compile(r"([A-Za-z_]\w*)\s*:")
 
 
 def parse_line(raw_line):
-    """Parse a source line into (label, mnemonic, operand_text).
+    """Parse a source line into (label, mnemonic, operand_text, operand_upper).
 
-    All can be None if the line is empty/comment-only.
+    All can be None if the line is empty/comment-only. operand_upper is
+    operand_text upper-cased once here, for register and compound
+    instruction checks; operand_text keeps the case of symbols/strings.
     """
-    line = strip_comment(raw_line).strip()
+    line = raw_line.partition(";")[0].strip()  # ; starts a comment
     if not line:
-        return (None, None, None)
+        return (None, None, None, None)
 
     label = None
     # Check for label
-    m = re.match(r"^([A-Za-z_]\w*)\s*:", line)
+    m = RE_LABEL.match(line)
     if m:
         label = m.group(1)
         line = line[m.end():].strip()
 
     if not line:
-        return (label, None, None)
+        return (label, None, None, None)
 
     # Split mnemonic from operand
     parts = line.split(None, 1)
     mnemonic = parts[0].upper()
-    operand_text = parts[1].strip() if len(parts) > 1 else None
-
-    return (label, mnemonic, operand_text)
+    if len(parts) > 1:
+        operand_text = parts[1].strip()
+        return (label, mnemonic, operand_text, operand_text.upper())
+    return (label, mnemonic, None, None)
 
 # ---------------------------------------------------------------------------
 # Assembler
@@ -310,10 +322,15 @@ class AssemblerError(Exception):
 
 
 class Assembler:
-    def __init__(self):
+    def __init__(self, keep_listing=True):
+        self.keep_listing = keep_listing  # build the .lst data in pass 2
         self.symbols = {}   # name -> value
         self.pc = 0
         self.errors = []
+        self.branches = []  # (line_num, start_pc, target shape) from pass 1
+        self.branch_disp = {}  # line_num -> displacement byte
+        self.output = bytearray(256)  # memory image
+        self.used = bytearray(256)    # 1 where the image holds code/data
 
     def error(self, line_num, msg):
         self.errors.append(AssemblerError(line_num, msg))
@@ -327,104 +344,232 @@ class Assembler:
             return 0
         return value_or_sym
 
-    def _parse_ld_st_operand(self, operand_text):
+    def _parse_ld_st_operand(self, operand_text, operand_upper):
         """Split LD/ST operand into (register, source/dest text).
 
         E.g. "A, #5" -> ("A", "#5"), "R0, [0x50]" -> ("R0", "[0x50]")
         """
         if operand_text is None:
             return (None, None)
-        parts = operand_text.split(",", 1)
-        if len(parts) < 2:
-            return (parts[0].strip().upper(), None)
-        return (parts[0].strip().upper(), parts[1].strip())
+        reg, comma, _ = operand_upper.partition(",")
+        if not comma:
+            return (reg.strip(), None)
+        return (reg.strip(), operand_text.partition(",")[2].strip())
 
-    def _operand_size(self, operand_text):
-        """Return 1 if register mode (no operand byte), else 2."""
-        if operand_text is None:
-            return 1
-        mode, _, _ = parse_operand(operand_text)
-        return 1 if mode == "reg" else 2
+    def operand_value(self, shape, line_num):
+        """Resolve the value of an operand shape against the symbol table.
 
-    def instruction_size(self, mnemonic, operand_text):
-        """Return the number of bytes this instruction will occupy."""
+        Returns None for register mode, else an integer.
+        """
+        mode, _, value_text = shape
+        if value_text is None:
+            return 0 if mode == "indexed" else None
+        val = parse_number(value_text, self.symbols)
+        if val is None:
+            return self.resolve(value_text, line_num)
+        return val
 
-        # Directives
-        if mnemonic == ".ORG":
-            return 0
-        if mnemonic == ".EQU":
-            return 0
-        if mnemonic == ".DB":
-            if operand_text:
-                items = [x.strip() for x in operand_text.split(",")]
-                count = 0
-                for item in items:
-                    if item.startswith('"') or item.startswith("'"):
-                        s = item.strip("\"'")
-                        count += len(s)
-                    else:
-                        count += 1
-                return count
-            return 0
-        if mnemonic == ".DS":
-            if operand_text:
-                s = operand_text.strip()
-                if (s.startswith('"') and s.endswith('"')) or \
-                   (s.startswith("'") and s.endswith("'")):
-                    return len(decode_string(s[1:-1])) + 1  # +1 for null
-                return 1  # error will be caught in pass 2
-            return 1
-
-        # LD / ST — two-operand
-        if mnemonic in ("LD", "ST"):
-            reg, src_text = self._parse_ld_st_operand(operand_text)
-            if src_text is None:
-                return 1  # error will be caught later
-            return self._operand_size(src_text)
-
-        # Compound fixed instructions (PUSH/POP/INC/DEC with register operand)
+    def _operand_size(self, shape):
+        """Return 1 if register mode (no operand byte), else 2."""
+        return 1 if shape[0] == "reg" else 2
+
+    # -------------------------------------------------------------------
+    # Pass 1 handlers: pre-parse a line, return (operand, size)
+    # -------------------------------------------------------------------
+    def _size_db(self, mnemonic, operand_text, operand_upper):
+        """.DB operand is the list of stripped items, split only once."""
         if operand_text:
-            combined = f"{mnemonic} {operand_text.strip().upper()}"
-            if combined in FIXED_OPCODES:
-                return 1  # all compound fixed are 1 byte
+            items = []
+            count = 0
+            for x in operand_text.split(","):
+                item = x.strip()
+                if item.startswith('"') or item.startswith("'"):
+                    s = item.strip("\"'")
+                    count += len(s)
+                else:
+                    item = sys.intern(item)  # symbol or numeric literal
+                    count += 1
+                items.append(item)
+            return (items, count)
+        return (None, 0)
 
-        # Simple fixed instructions
-        if mnemonic in FIXED_OPCODES:
-            if mnemonic in NO_OPERAND:
-                return 1
-            return 2  # JMP, CALL, branches
+    def _size_ds(self, mnemonic, operand_text, operand_upper):
+        if operand_text:
+            s = operand_text.strip()
+            if (s.startswith('"') and s.endswith('"')) or \
+               (s.startswith("'") and s.endswith("'")):
+                data, err = decode_string(s[1:-1])
+                if err is not None:
+                    return (s, 1)  # error will be caught in pass 2
+                return (s, len(data) + 1)  # +1 for null
+            return (s, 1)  # error will be caught in pass 2
+        return (None, 1)
+
+    def _size_ld_st(self, mnemonic, operand_text, operand_upper):
+        """LD / ST operand is (register, source/dest text, shape)."""
+        reg, src_text = self._parse_ld_st_operand(operand_text, operand_upper)
+        if src_text is None:
+            return ((reg, None, None), 1)  # error will be caught later
+        shape = parse_operand_shape(src_text)
+        return ((reg, src_text, shape), self._operand_size(shape))
+
+    def _size_fixed(self, mnemonic, operand_text, operand_upper):
+        return (None, 1)
+
+    def _size_jmp_call(self, mnemonic, operand_text, operand_upper):
+        """JMP, CALL and branches: opcode + address/displacement byte."""
+        if operand_text is None:
+            return (None, 2)
+        return (parse_operand_shape(operand_text), 2)
 
-        # ALU instructions
-        if mnemonic in ALU_INSTRUCTIONS:
-            if operand_text is None:
-                return 1  # error will be caught later
-            return self._operand_size(operand_text)
+    def _size_alu(self, mnemonic, operand_text, operand_upper):
+        if operand_text is None:
+            return (None, 1)  # error will be caught later
+        shape = parse_operand_shape(operand_text)
+        return (shape, self._operand_size(shape))
 
-        return 1  # unknown — will error in pass 2
+    # -------------------------------------------------------------------
+    # Pass 2 handlers: return the list of emitted bytes
+    # -------------------------------------------------------------------
+    def _emit_db(self, mnemonic, items, start_pc, line_num):
+        emitted = []
+        if items:
+            for item in items:
+                if item.startswith('"') or item.startswith("'"):
+                    s = item.strip("\"'")
+                    for ch in s:
+                        emitted.append(ord(ch))
+                else:
+                    val = parse_number(item, self.symbols)
+                    if val is None:
+                        val = self.resolve(item, line_num)
+                    emitted.append(val & 0xFF)
+        return emitted
+
+    def _emit_ds(self, mnemonic, s, start_pc, line_num):
+        emitted = []
+        if s:
+            if (s.startswith('"') and s.endswith('"')) or \
+               (s.startswith("'") and s.endswith("'")):
+                data, err = decode_string(s[1:-1])
+                if err is not None:
+                    self.error(line_num, err)
+                else:
+                    emitted.extend(data)
+            else:
+                self.error(line_num, ".DS requires a quoted string")
+        else:
+            self.error(line_num, ".DS requires a quoted string")
+        emitted.append(0x00)  # null terminator
+        return emitted
+
+    def _emit_ld_st(self, mnemonic, operand, start_pc, line_num):
+        is_store = (mnemonic == "ST")
+        reg, src_text, shape = operand
+
+        if reg not in REGISTER_NAMES:
+            self.error(line_num,
+                       f"{mnemonic} requires A, R0, or R1 as "
+                       f"first operand, got '{reg}'")
+            return [0]
+        if src_text is None:
+            self.error(line_num,
+                       f"{mnemonic} {reg} requires a second operand")
+            return [0]
+
+        mode, other_reg, _ = shape
+        # Resolve "value" mode as immediate for LD, or as direct for ST
+        if mode == "value":
+            if is_store:
+                mode = "direct"
+            else:
+                mode = "imm"
+        val = self.operand_value(shape, line_num)
+        opcode, operand_byte, err = encode_ld_st(
+            is_store, reg, mode, other_reg, val if val is not None else 0)
+        if err is not None:
+            self.error(line_num, err)
+            return [0]
+        if operand_byte is None:
+            return [opcode]
+        return [opcode, operand_byte]
+
+    def _emit_fixed(self, mnemonic, operand, start_pc, line_num):
+        """No-operand fixed opcodes, incl. compound PUSH/POP/INC/DEC reg."""
+        return [FIXED_OPCODES[mnemonic]]
+
+    def _emit_jmp_call(self, mnemonic, operand, start_pc, line_num):
+        if operand is None:
+            self.error(line_num, f"{mnemonic} requires an address")
+            return [FIXED_OPCODES[mnemonic], 0]
+        val = self.operand_value(operand, line_num)
+        return [FIXED_OPCODES[mnemonic], val & 0xFF]
+
+    def _emit_branch(self, mnemonic, operand, start_pc, line_num):
+        if operand is None:
+            self.error(line_num, f"{mnemonic} requires a target")
+            return [FIXED_OPCODES[mnemonic], 0]
+        return [FIXED_OPCODES[mnemonic], self.branch_disp[line_num]]
+
+    def _emit_alu(self, mnemonic, operand, start_pc, line_num):
+        if operand is None:
+            self.error(line_num, f"{mnemonic} requires an operand")
+            return [0]
+        mode, reg, _ = operand
+        if mode == "value":
+            # Bare number/symbol — treat as immediate
+            mode = "imm"
+        val = self.operand_value(operand, line_num)
+        opcode, operand_byte, err = encode_alu(
+            mnemonic, mode, reg, val if val is not None else 0)
+        if err is not None:
+            self.error(line_num, err)
+            return [0]
+        if operand_byte is None:
+            return [opcode]
+        return [opcode, operand_byte]
 
     # -------------------------------------------------------------------
     # Pass 1: build symbol table
     # -------------------------------------------------------------------
     def pass1(self, lines):
+        """Build the symbol table and pre-parse every line.
+
+        lines may be any iterable of source lines, consumed once.
+        Returns a list of (line_num, raw_line, mnemonic, operand, pc)
+        records that pass 2 consumes, so no line is parsed twice. pc is
+        the address pass 1 assigned to the line; raw_line is only kept
+        (for the listing) if keep_listing is set, else None.
+        """
         self.pc = 0
+        parsed_lines = []
+        branches = self.branches = []
+        size_dispatch = SIZE_DISPATCH    # hot-loop local aliases
+        compound_fixed = COMPOUND_FIXED
+        keep_listing = self.keep_listing
         for line_num, raw_line in enumerate(lines, 1):
-            label, mnemonic, operand_text = parse_line(raw_line)
+            label, mnemonic, operand_text, operand_upper = parse_line(raw_line)
+            if not keep_listing:
+                raw_line = None
 
             if label:
                 if label in self.symbols:
                     self.error(line_num, f"Duplicate label '{label}'")
                 else:
-                    self.symbols[label] = self.pc
+                    self.symbols[sys.intern(label)] = self.pc
 
             if mnemonic is None:
+                parsed_lines.append((line_num, raw_line, None, None, None))
                 continue
 
             if mnemonic == ".ORG":
                 val = parse_number(operand_text, self.symbols) if operand_text else None
-                if val is None:
+                if val is None or not 0 <= val <= 0xFF:
                     self.error(line_num, "Invalid .ORG address")
                 else:
                     self.pc = val
+                parsed_lines.append(
+                    (line_num, raw_line, mnemonic, None, self.pc))
                 continue
 
             if mnemonic == ".EQU":
@@ -437,290 +582,246 @@ class Assembler:
                             self.error(line_num,
                                        f"Invalid .EQU value '{parts[1]}'")
                         else:
-                            self.symbols[name] = val
+                            self.symbols[sys.intern(name)] = val
                     else:
                         self.error(line_num,
                                    "Invalid .EQU syntax "
                                    "(expected: .EQU name, value)")
+                parsed_lines.append((line_num, raw_line, mnemonic, None, None))
                 continue
 
-            size = self.instruction_size(mnemonic, operand_text)
+            # Compound fixed instructions (PUSH/POP/INC/DEC with register
+            # operand) are folded into a single mnemonic, e.g. "PUSH A".
+            if operand_text:
+                mnemonic = compound_fixed.get(
+                    (mnemonic, operand_upper), mnemonic)
+
+            handler = size_dispatch.get(mnemonic)
+            if handler is None:
+                operand, size = None, 1  # unknown — will error in pass 2
+            else:
+                operand, size = handler(
+                    self, mnemonic, operand_text, operand_upper)
+                if mnemonic in BRANCH_INSTRUCTIONS and operand is not None:
+                    branches.append((line_num, self.pc, operand))
+            parsed_lines.append(
+                (line_num, raw_line, mnemonic, operand, self.pc))
             self.pc += size
 
+        return parsed_lines
+
+    def resolve_branches(self):
+        """Compute every branch displacement in one sweep after pass 1.
+
+        Fills self.branch_disp (line_num -> two's complement byte) from
+        the branch records pass 1 collected, reporting undefined targets
+        and out-of-range displacements.
+        """
+        branch_disp = self.branch_disp = {}
+        for line_num, start_pc, shape in self.branches:
+            target = self.operand_value(shape, line_num)
+            # PC after this instruction = start_pc + 2
+            disp = target - (start_pc + 2)
+            if disp < -128 or disp > 127:
+                self.error(
+                    line_num,
+                    f"Branch displacement {disp} out of range (-128..+127)")
+                disp = 0
+            branch_disp[line_num] = disp & 0xFF
+
     # -------------------------------------------------------------------
     # Pass 2: generate machine code
     # -------------------------------------------------------------------
-    def pass2(self, lines):
-        self.pc = 0
-        output = {}    # address -> byte
-        listing = []   # (address, bytes, raw_source_line)
-
-        for line_num, raw_line in enumerate(lines, 1):
-            label, mnemonic, operand_text = parse_line(raw_line)
-
-            if mnemonic is None:
-                listing.append((None, [], raw_line))
+    def pass2(self, parsed_lines):
+        """Emit every line at the address pass 1 assigned to it."""
+        output = self.output = bytearray(256)
+        used = self.used = bytearray(256)
+        keep_listing = self.keep_listing
+        listing = [] if keep_listing else None  # (address, bytes, raw_line)
+        emit_dispatch = EMIT_DISPATCH  # hot-loop local alias
+
+        for line_num, raw_line, mnemonic, operand, start_pc in parsed_lines:
+
+            if mnemonic is None or mnemonic == ".EQU":
+                if keep_listing:
+                    listing.append((None, [], raw_line))
                 continue
 
             if mnemonic == ".ORG":
-                val = parse_number(operand_text, self.symbols) \
-                    if operand_text else 0
-                if val is not None:
-                    self.pc = val
-                listing.append((self.pc, [], raw_line))
-                continue
-
-            if mnemonic == ".EQU":
-                listing.append((None, [], raw_line))
+                if keep_listing:
+                    listing.append((start_pc, [], raw_line))
                 continue
 
-            start_pc = self.pc
-            emitted = []
-
-            if mnemonic == ".DB":
-                if operand_text:
-                    items = [x.strip() for x in operand_text.split(",")]
-                    for item in items:
-                        if item.startswith('"') or item.startswith("'"):
-                            s = item.strip("\"'")
-                            for ch in s:
-                                emitted.append(ord(ch))
-                        else:
-                            val = parse_number(item, self.symbols)
-                            if val is None:
-                                val = self.resolve(item, line_num)
-                            emitted.append(val & 0xFF)
-
-            elif mnemonic == ".DS":
-                if operand_text:
-                    s = operand_text.strip()
-                    if (s.startswith('"') and s.endswith('"')) or \
-                       (s.startswith("'") and s.endswith("'")):
-                        try:
-                            emitted.extend(decode_string(s[1:-1]))
-                        except ValueError as e:
-                            self.error(line_num, str(e))
-                    else:
-                        self.error(line_num,
-                                   ".DS requires a quoted string")
-                else:
-                    self.error(line_num, ".DS requires a quoted string")
-                emitted.append(0x00)  # null terminator
-
-            # --- LD / ST (two-operand) ---
-            elif mnemonic in ("LD", "ST"):
-                is_store = (mnemonic == "ST")
-                reg, src_text = self._parse_ld_st_operand(operand_text)
-
-                if reg not in REGISTER_NAMES:
-                    self.error(line_num,
-                               f"{mnemonic} requires A, R0, or R1 as "
-                               f"first operand, got '{reg}'")
-                    emitted.append(0)
-                elif src_text is None:
-                    self.error(line_num,
-                               f"{mnemonic} {reg} requires a second operand")
-                    emitted.append(0)
-                else:
-                    mode, other_reg, val = parse_operand(
-                        src_text, self.symbols)
-                    # Resolve "value" mode as immediate for LD,
-                    # or as direct for ST
-                    if mode == "value":
-                        if is_store:
-                            mode = "direct"
-                        else:
-                            mode = "imm"
-                    if val is not None and isinstance(val, str):
-                        val = self.resolve(val, line_num)
-                    try:
-                        opcode, operand = encode_ld_st(
-                            is_store, reg, mode, other_reg,
-                            val if val is not None else 0)
-                        emitted.append(opcode)
-                        if operand is not None:
-                            emitted.append(operand)
-                    except ValueError as e:
-                        self.error(line_num, str(e))
-                        emitted.append(0)
-
-            # --- Compound fixed (PUSH/POP/INC/DEC reg) ---
-            elif operand_text and \
-                    f"{mnemonic} {operand_text.strip().upper()}" \
-                    in FIXED_OPCODES:
-                combined = f"{mnemonic} {operand_text.strip().upper()}"
-                emitted.append(FIXED_OPCODES[combined])
-
-            # --- Simple fixed: no-operand ---
-            elif mnemonic in NO_OPERAND and mnemonic in FIXED_OPCODES:
-                emitted.append(FIXED_OPCODES[mnemonic])
-
-            # --- JMP / CALL ---
-            elif mnemonic in ("JMP", "CALL"):
-                opcode = FIXED_OPCODES[mnemonic]
-                emitted.append(opcode)
-                if operand_text is None:
-                    self.error(line_num, f"{mnemonic} requires an address")
-                    emitted.append(0)
-                else:
-                    parsed = parse_operand(operand_text, self.symbols)
-                    val = self.resolve(parsed[2], line_num)
-                    emitted.append(val & 0xFF)
-
-            # --- Branches ---
-            elif mnemonic in BRANCH_INSTRUCTIONS:
-                opcode = FIXED_OPCODES[mnemonic]
-                emitted.append(opcode)
-                if operand_text is None:
-                    self.error(line_num, f"{mnemonic} requires a target")
-                    emitted.append(0)
-                else:
-                    parsed = parse_operand(operand_text, self.symbols)
-                    target = self.resolve(parsed[2], line_num)
-                    # PC after this instruction = start_pc + 2
-                    disp = target - (start_pc + 2)
-                    if disp < -128 or disp > 127:
-                        self.error(
-                            line_num,
-                            f"Branch displacement {disp} out of range "
-                            f"(-128..+127)")
-                        disp = 0
-                    emitted.append(disp & 0xFF)  # two's complement
-
-            # --- ALU instructions ---
-            elif mnemonic in ALU_INSTRUCTIONS:
-                if operand_text is None:
-                    self.error(line_num,
-                               f"{mnemonic} requires an operand")
-                    emitted.append(0)
-                else:
-                    mode, reg, val = parse_operand(
-                        operand_text, self.symbols)
-                    if mode == "value":
-                        # Bare number/symbol — treat as immediate
-                        mode = "imm"
-                    if val is not None and isinstance(val, str):
-                        val = self.resolve(val, line_num)
-                    try:
-                        opcode, operand = encode_alu(
-                            mnemonic, mode, reg,
-                            val if val is not None else 0)
-                        emitted.append(opcode)
-                        if operand is not None:
-                            emitted.append(operand)
-                    except ValueError as e:
-                        self.error(line_num, str(e))
-                        emitted.append(0)
-
-            else:
+            handler = emit_dispatch.get(mnemonic)
+            if handler is None:
                 self.error(line_num,
                            f"Unknown instruction '{mnemonic}'")
-                emitted.append(0)
+                emitted = [0]
+            else:
+                emitted = handler(self, mnemonic, operand, start_pc, line_num)
 
             # Write emitted bytes to output
-            for i, b in enumerate(emitted):
-                addr = start_pc + i
-                if addr > 0xFF:
-                    self.error(line_num,
-                               f"Address 0x{addr:02X} exceeds memory")
-                    break
-                output[addr] = b
+            end = start_pc + len(emitted)
+            if end <= 0x100:
+                output[start_pc:end] = emitted
+                used[start_pc:end] = b"\x01" * len(emitted)
+            elif emitted:
+                if start_pc <= 0xFF:
+                    # Keep the bytes that fit, report the first that doesn't
+                    output[start_pc:] = emitted[:0x100 - start_pc]
+                    used[start_pc:] = b"\x01" * (0x100 - start_pc)
+                    addr = 0x100
+                else:
+                    addr = start_pc
+                self.error(line_num,
+                           f"Address 0x{addr:02X} exceeds memory")
 
-            listing.append((start_pc, emitted, raw_line))
-            self.pc = start_pc + len(emitted)
+            if keep_listing:
+                listing.append((start_pc, emitted, raw_line))
 
-        return output, listing
+        return output, used, listing
 
     # -------------------------------------------------------------------
     # Main assemble entry point
     # -------------------------------------------------------------------
-    def assemble(self, source_text):
-        lines = source_text.splitlines()
-        self.pass1(lines)
+    def assemble(self, source):
+        """Assemble source text or an open text file.
+
+        Returns (output, used, listing). output is the 256-byte memory
+        image and used flags (1/0) which of its addresses were written.
+        listing is None unless keep_listing is set. All three are None if
+        pass 1 failed. Lines are streamed, never held as a list.
+        """
+        if isinstance(source, str):
+            source = io.StringIO(source, newline=None)
+        # Re-split each physical line so \f, \v, \x1c-\x1e, \x85, \u2028
+        # and \u2029 end lines exactly as str.splitlines() does
+        lines = (line for chunk in source for line in chunk.splitlines())
+        parsed_lines = self.pass1(lines)
         if self.errors:
-            return None, None
-        output, listing = self.pass2(lines)
-        return output, listing
+            return None, None, None
+        self.resolve_branches()
+        result = self.pass2(parsed_lines)
+        self.errors.sort(key=lambda e: e.line_num)  # report in source order
+        return result
+
+# Per-mnemonic handlers. SIZE_DISPATCH pre-parses a line in pass 1 from
+# (mnemonic, operand_text, operand_upper) and returns (operand, size);
+# EMIT_DISPATCH turns that operand into bytes in pass 2. Compound fixed
+# instructions are keyed by their full text.
+SIZE_DISPATCH = {
+    ".DB": Assembler._size_db,
+    ".DS": Assembler._size_ds,
+    "LD":  Assembler._size_ld_st,
+    "ST":  Assembler._size_ld_st,
+}
+EMIT_DISPATCH = {
+    ".DB": Assembler._emit_db,
+    ".DS": Assembler._emit_ds,
+    "LD":  Assembler._emit_ld_st,
+    "ST":  Assembler._emit_ld_st,
+}
+for _mnemonic in FIXED_OPCODES:
+    if _mnemonic in NO_OPERAND:
+        SIZE_DISPATCH[_mnemonic] = Assembler._size_fixed
+        EMIT_DISPATCH[_mnemonic] = Assembler._emit_fixed
+    elif _mnemonic in BRANCH_INSTRUCTIONS:
+        SIZE_DISPATCH[_mnemonic] = Assembler._size_jmp_call
+        EMIT_DISPATCH[_mnemonic] = Assembler._emit_branch
+    else:
+        SIZE_DISPATCH[_mnemonic] = Assembler._size_jmp_call
+        EMIT_DISPATCH[_mnemonic] = Assembler._emit_jmp_call
+for _mnemonic in ALU_INSTRUCTIONS:
+    SIZE_DISPATCH[_mnemonic] = Assembler._size_alu
+    EMIT_DISPATCH[_mnemonic] = Assembler._emit_alu
+del _mnemonic
 
 # ---------------------------------------------------------------------------
 # Output generation
 # ---------------------------------------------------------------------------
 
-def generate_bin(output):
-    """Generate a raw binary image from the output dict (addr -> byte)."""
-    if not output:
-        return bytes()
-    max_addr = max(output.keys())
-    buf = bytearray(max_addr + 1)
-    for addr, val in output.items():
-        buf[addr] = val
-    return bytes(buf)
-
-
-def generate_hex(output):
-    """Generate Intel HEX format from the output dict (addr -> byte)."""
-    if not output:
-        return ":00000001FF\n"
+def _used_runs(used):
+    """Yield (start, end) for each run of contiguous used addresses."""
+    start = used.find(1)
+    while start >= 0:
+        end = used.find(0, start)
+        if end < 0:
+            end = len(used)
+        yield start, end
+        start = used.find(1, end)
+
+
+# Maps used-flag bytes to binary digits for used_mask()
+_USED_DIGITS = bytes.maketrans(b"\x00\x01", b"01")
+
+
+def used_mask(used):
+    """Return the used flags as an int with bit n set if address n is used.
+
+    This is the mask form the simulator's load_map() takes.
+    """
+    return int(used[::-1].translate(_USED_DIGITS), 2)
+
+
+def _records(output, used):
+    """Yield (base, data) for each HEX/S-record data record.
+
+    Each run of used bytes becomes full 16-byte records sliced straight
+    from the image, then at most one shorter tail record.
+    """
+    for start, end in _used_runs(used):
+        tail = end - (end - start) % 16
+        for base in range(start, tail, 16):
+            yield base, output[base:base + 16]
+        if tail < end:
+            yield tail, output[tail:end]
+
+
+def generate_bin(output, used):
+    """Generate a raw binary image, trimmed after the last used address."""
+    return bytes(output[:used.rfind(1) + 1])
+
+
+def generate_hex(output, used):
+    """Generate Intel HEX format from the output image."""
     lines = []
-    # Collect addresses in order, emit up to 16 bytes per record
-    addrs = sorted(output.keys())
-    i = 0
-    while i < len(addrs):
-        base = addrs[i]
-        data = []
-        # Gather contiguous bytes, up to 16 per record
-        while i < len(addrs) and addrs[i] == base + len(data) and len(data) < 16:
-            data.append(output[addrs[i]])
-            i += 1
+    for base, data in _records(output, used):
         # Data record: :LLAAAATT[DD...]CC
         length = len(data)
         addr_hi = (base >> 8) & 0xFF
         addr_lo = base & 0xFF
-        record = [length, addr_hi, addr_lo, 0x00] + data
-        checksum = (~sum(record) + 1) & 0xFF
-        hex_str = "".join(f"{b:02X}" for b in record) + f"{checksum:02X}"
-        lines.append(f":{hex_str}")
+        checksum = (~(length + addr_hi + addr_lo + sum(data)) + 1) & 0xFF
+        lines.append(f":{length:02X}{base:04X}00{data.hex().upper()}"
+                     f"{checksum:02X}")
     # EOF record
     lines.append(":00000001FF")
     return "\n".join(lines) + "\n"
 
 
-def generate_srec(output):
-    """Generate Motorola S-record format from the output dict (addr -> byte)."""
+def generate_srec(output, used):
+    """Generate Motorola S-record format from the output image."""
     lines = []
     # S0 header record (optional, contains "EDU-CPU" as data)
-    header_data = list(b"EDU-CPU")
+    header_data = b"EDU-CPU"
     s0_count = 2 + 1 + len(header_data)  # addr(2) + data + checksum
-    s0_bytes = [s0_count, 0x00, 0x00] + header_data
+    s0_bytes = bytes((s0_count, 0x00, 0x00)) + header_data
     s0_checksum = (~sum(s0_bytes)) & 0xFF
-    lines.append("S0" + "".join(f"{b:02X}" for b in s0_bytes)
-                  + f"{s0_checksum:02X}")
-
-    if output:
-        # S1 data records (16-bit address)
-        addrs = sorted(output.keys())
-        i = 0
-        while i < len(addrs):
-            base = addrs[i]
-            data = []
-            while (i < len(addrs) and addrs[i] == base + len(data)
-                   and len(data) < 16):
-                data.append(output[addrs[i]])
-                i += 1
-            # byte count = addr(2) + data + checksum(1)
-            count = 2 + len(data) + 1
-            addr_hi = (base >> 8) & 0xFF
-            addr_lo = base & 0xFF
-            rec_bytes = [count, addr_hi, addr_lo] + data
-            checksum = (~sum(rec_bytes)) & 0xFF
-            lines.append("S1" + "".join(f"{b:02X}" for b in rec_bytes)
-                          + f"{checksum:02X}")
+    lines.append(f"S0{s0_bytes.hex().upper()}{s0_checksum:02X}")
+
+    # S1 data records (16-bit address)
+    for base, data in _records(output, used):
+        # byte count = addr(2) + data + checksum(1)
+        count = 2 + len(data) + 1
+        addr_hi = (base >> 8) & 0xFF
+        addr_lo = base & 0xFF
+        checksum = (~(count + addr_hi + addr_lo + sum(data))) & 0xFF
+        lines.append(f"S1{count:02X}{base:04X}{data.hex().upper()}"
+                     f"{checksum:02X}")
 
     # S9 end record (start address 0x0000)
-    s9_bytes = [0x03, 0x00, 0x00]
+    s9_bytes = bytes((0x03, 0x00, 0x00))
     s9_checksum = (~sum(s9_bytes)) & 0xFF
-    lines.append("S9" + "".join(f"{b:02X}" for b in s9_bytes)
-                  + f"{s9_checksum:02X}")
+    lines.append(f"S9{s9_bytes.hex().upper()}{s9_checksum:02X}")
     return "\n".join(lines) + "\n"
 
 
@@ -743,24 +844,32 @@ def generate_lst(listing):
 # ---------------------------------------------------------------------------
 
 def main():
-    import argparse
-
-    parser = argparse.ArgumentParser(description="EDU-CPU Assembler")
-    parser.add_argument("source", help="Assembly source file (.asm)")
-    parser.add_argument(
-        "--format", choices=["bin", "hex", "srec"], default="bin",
-        help="Output format: bin (raw binary, default), "
-             "hex (Intel HEX), srec (Motorola S-record)")
-    args = parser.parse_args()
+    argv = sys.argv[1:]
+    if len(argv) == 1 and not argv[0].startswith("-"):
+        # Common case (just a source file): skip importing argparse, which
+        # dominates startup when a build runs the assembler once per file.
+        source_path, out_format, keep_listing = argv[0], "bin", True
+    else:
+        import argparse
+
+        parser = argparse.ArgumentParser(description="EDU-CPU Assembler")
+        parser.add_argument("source", help="Assembly source file (.asm)")
+        parser.add_argument(
+            "--format", choices=["bin", "hex", "srec"], default="bin",
+            help="Output format: bin (raw binary, default), "
+                 "hex (Intel HEX), srec (Motorola S-record)")
+        parser.add_argument(
+            "--no-listing", action="store_true",
+            help="Do not build or write the .lst listing file")
+        args = parser.parse_args(argv)
+        source_path, out_format = args.source, args.format
+        keep_listing = not args.no_listing
 
-    source_path = args.source
     base_name = os.path.splitext(source_path)[0]
 
+    asm = Assembler(keep_listing=keep_listing)
     with open(source_path, "r") as f:
-        source = f.read()
-
-    asm = Assembler()
-    output, listing = asm.assemble(source)
+        output, used, listing = asm.assemble(f)
 
     if asm.errors:
         for err in asm.errors:
@@ -768,28 +877,29 @@ def main():
         sys.exit(1)
 
     # Write output in selected format
-    if args.format == "hex":
+    if out_format == "hex":
         out_path = base_name + ".hex"
         with open(out_path, "w") as f:
-            f.write(generate_hex(output))
+            f.write(generate_hex(output, used))
         print(f"Intel HEX: {out_path}")
-    elif args.format == "srec":
+    elif out_format == "srec":
         out_path = base_name + ".srec"
         with open(out_path, "w") as f:
-            f.write(generate_srec(output))
+            f.write(generate_srec(output, used))
         print(f"Motorola SREC: {out_path}")
     else:
         out_path = base_name + ".bin"
-        bin_data = generate_bin(output)
+        bin_data = generate_bin(output, used)
         with open(out_path, "wb") as f:
             f.write(bin_data)
         print(f"Binary:  {out_path} ({len(bin_data)} bytes)")
 
     # Write .LST
-    lst_path = base_name + ".lst"
-    with open(lst_path, "w") as f:
-        f.write(generate_lst(listing))
-    print(f"Listing: {lst_path}")
+    if keep_listing:
+        lst_path = base_name + ".lst"
+        with open(lst_path, "w") as f:
+            f.write(generate_lst(listing))
+        print(f"Listing: {lst_path}")
 
 
 if __name__ == "__main__":
@@ -3,7 +3,6 @@
 
 import sys
 import os
-import argparse
 
 # ---------------------------------------------------------------------------
 # Instruction decode tables
@@ -31,11 +30,11 @@ ALU_OPCODES = {
     0b01011: "CMP",
 }
 
-BRANCH_CONDITION = {
-    0x68: ("BZ",  lambda z, c: z),
-    0x69: ("BNZ", lambda z, c: not z),
-    0x6A: ("BC",  lambda z, c: c),
-    0x6B: ("BNC", lambda z, c: not c),
+BRANCH_OPCODES = {
+    0x68: "BZ",
+    0x69: "BNZ",
+    0x6A: "BC",
+    0x6B: "BNC",
 }
 
 # Register mode R-bit mapping: for each primary register, R=0 and R=1
@@ -50,21 +49,76 @@ REG_MODE_MAP = {
 # PUSH/POP/INC/DEC register encoding (bits 1-0)
 REG_ENCODING = {0: "A", 1: "R0", 2: "R1"}
 
+# The tables above as tuples indexed directly by IIIII (32 entries),
+# opcode (256) or register code (4); None marks codes not in the table
+LD_TABLE = tuple(LD_OPCODES.get(i) for i in range(32))
+ST_TABLE = tuple(ST_OPCODES.get(i) for i in range(32))
+ALU_TABLE = tuple(ALU_OPCODES.get(i) for i in range(32))
+BRANCH_TABLE = tuple(BRANCH_OPCODES.get(op) for op in range(256))
+REG_TABLE = tuple(REG_ENCODING.get(i) for i in range(4))
+
 IO_ADDR = 0xFF
+IO_FLUSH_SIZE = 256  # buffered I/O port bytes written out at once
+RUN_BATCH = 256      # instructions run between max-cycles checks
 STACK_DEPTH = 4
 
 # ---------------------------------------------------------------------------
-# File format parsers — return {address: byte} dicts
+# File format parsers — return (image, mask) pairs: image is a 256-byte
+# bytearray, and bit n of the int mask is set when address n is present
 # ---------------------------------------------------------------------------
 
+def _mask_addrs(mask):
+    """Yield the addresses whose bits are set in mask, in ascending order."""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def _mask_runs(mask):
+    """Yield (start, end) for each run of contiguous set bits in mask."""
+    addr = 0
+    while mask:
+        skip = (mask & -mask).bit_length() - 1
+        mask >>= skip
+        addr += skip
+        # Trailing ones: the lowest clear bit is (mask + 1) & ~mask
+        length = ((mask + 1) & ~mask).bit_length() - 1
+        yield addr, addr + length
+        mask >>= length
+        addr += length
+
+
+def _store(image, mask, addr, data):
+    """Copy a record's data into image at addr; return the updated mask.
+
+    Bytes past 0xFF fall outside the address space and are dropped.
+    """
+    end = min(addr + len(data), 256)
+    if addr >= end:
+        return mask
+    image[addr:end] = data[:end - addr]
+    return mask | (((1 << (end - addr)) - 1) << addr)
+
+
+def _record_sum(raw):
+    """Sum a record's bytes, excluding the trailing checksum byte.
+
+    Subtracts the checksum from the full sum rather than slicing it off.
+    """
+    return sum(raw) - raw[-1]
+
+
 def parse_bin(data):
-    """Parse a raw binary image. Returns {addr: byte}."""
-    return {i: b for i, b in enumerate(data) if i < 256}
+    """Parse a raw binary image. Returns (image, mask)."""
+    image = bytearray(256)
+    return image, _store(image, 0, 0, data)
 
 
 def parse_hex(text):
-    """Parse Intel HEX format. Returns {addr: byte}."""
-    result = {}
+    """Parse Intel HEX format. Returns (image, mask)."""
+    image = bytearray(256)
+    mask = 0
     for line_num, line in enumerate(text.splitlines(), 1):
         line = line.strip()
         if not line:
@@ -81,7 +135,7 @@ def parse_hex(text):
         rec_type = raw[3]
         data = raw[4:-1]
         checksum = raw[-1]
-        calc = (~sum(raw[:-1]) + 1) & 0xFF
+        calc = (~_record_sum(raw) + 1) & 0xFF
         if calc != checksum:
             raise ValueError(
                 f"Intel HEX line {line_num}: checksum mismatch "
@@ -92,16 +146,14 @@ def parse_hex(text):
         if rec_type == 0x01:  # EOF
             break
         if rec_type == 0x00:  # Data
-            for i, b in enumerate(data):
-                a = addr + i
-                if a < 256:
-                    result[a] = b
-    return result
+            mask = _store(image, mask, addr, data)
+    return image, mask
 
 
 def parse_srec(text):
-    """Parse Motorola S-record format. Returns {addr: byte}."""
-    result = {}
+    """Parse Motorola S-record format. Returns (image, mask)."""
+    image = bytearray(256)
+    mask = 0
     for line_num, line in enumerate(text.splitlines(), 1):
         line = line.strip()
         if not line:
@@ -118,7 +170,7 @@ def parse_srec(text):
         if len(raw) != byte_count + 1:
             raise ValueError(
                 f"SREC line {line_num}: byte count mismatch")
-        calc = (~sum(raw[:-1])) & 0xFF
+        calc = (~_record_sum(raw)) & 0xFF
         if calc != raw[-1]:
             raise ValueError(
                 f"SREC line {line_num}: checksum mismatch "
@@ -128,13 +180,10 @@ def parse_srec(text):
         elif rec_type == "1":  # Data with 16-bit address
             addr = (raw[1] << 8) | raw[2]
             data = raw[3:-1]
-            for i, b in enumerate(data):
-                a = addr + i
-                if a < 256:
-                    result[a] = b
+            mask = _store(image, mask, addr, data)
         elif rec_type == "9":  # End record
             break
-    return result
+    return image, mask
 
 
 # ---------------------------------------------------------------------------
@@ -142,58 +191,71 @@ def parse_srec(text):
 # ---------------------------------------------------------------------------
 
 class CPU:
-    def __init__(self):
+    """EDU-CPU state and interpreter.
+
+    io_write, if given, is called with each byte written to the I/O port;
+    otherwise output is buffered and written to sys.stdout. log is the text
+    stream for trace lines and run() messages (default: sys.stderr).
+    """
+
+    __slots__ = ("a", "r0", "r1", "pc", "z", "c", "sp", "stack_packed",
+                 "mem", "loaded_mask", "decoded", "halted", "cycles",
+                 "_outbuf", "_io_write", "log")
+
+    def __init__(self, io_write=None, log=None):
         self.a = 0       # accumulator
-        self.r = [0, 0]  # R0, R1
+        self.r0 = 0      # index register R0
+        self.r1 = 0      # index register R1
         self.pc = 0      # program counter
         self.z = False   # zero flag
         self.c = False   # carry flag
         self.sp = 0      # stack pointer (0..3)
-        self.stack = [0] * STACK_DEPTH
+        self.stack_packed = 0  # stack entries, one byte each, top lowest
         self.mem = bytearray(256)
-        self.loaded = set()  # addresses that contain loaded program data
+        self.loaded_mask = 0  # bit n set: address n holds loaded program data
+        # Decode cache: addr -> (handler, opcode, operand, length)
+        self.decoded = [None] * 256
         self.halted = False
         self.cycles = 0
+        self._outbuf = bytearray()  # I/O port bytes not yet written out
+        if io_write is None:
+            io_write = self._buffer_stdout
+        self._io_write = io_write
+        self.log = log
 
-    def _get_reg(self, name):
-        """Read a register by name."""
-        if name == "A":
-            return self.a
-        elif name == "R0":
-            return self.r[0]
-        elif name == "R1":
-            return self.r[1]
-
-    def _set_reg(self, name, val):
-        """Write a register by name."""
-        val &= 0xFF
-        if name == "A":
-            self.a = val
-        elif name == "R0":
-            self.r[0] = val
-        elif name == "R1":
-            self.r[1] = val
-
-    def load_map(self, addr_map):
-        """Apply an address->byte map to memory."""
-        for addr, val in addr_map.items():
-            if addr < 256:
-                self.mem[addr] = val
-                self.loaded.add(addr)
+    def reset(self):
+        """Return to the power-on state, keeping the I/O and log sinks.
+
+        Clears registers, flags, stack, memory and loaded addresses in
+        place so a CPU can be reused without reallocating its buffers.
+        """
+        self.a = self.r0 = self.r1 = 0
+        self.pc = 0
+        self.z = self.c = False
+        self.sp = 0
+        self.stack_packed = 0
+        self.mem[:] = bytes(256)
+        self.loaded_mask = 0
+        self.decoded[:] = [None] * 256
+        self.halted = False
+        self.cycles = 0
+        self._outbuf.clear()
+
+    def load_map(self, image, mask):
+        """Copy the addresses selected by mask from a 256-byte image."""
+        for start, end in _mask_runs(mask):
+            self.mem[start:end] = image[start:end]
+        self.loaded_mask |= mask
+        self.decoded[:] = [None] * 256
 
     def load_bin(self, data):
-        self.load_map(parse_bin(data))
+        self.load_map(*parse_bin(data))
 
     def load_hex(self, text):
-        self.load_map(parse_hex(text))
+        self.load_map(*parse_hex(text))
 
     def load_srec(self, text):
-        self.load_map(parse_srec(text))
-
-    def fetch(self):
-        val = self.mem[self.pc]
-        self.pc = (self.pc + 1) & 0xFF
-        return val
+        self.load_map(*parse_srec(text))
 
     def mem_read(self, addr):
         return self.mem[addr & 0xFF]
@@ -202,228 +264,78 @@ class CPU:
         addr &= 0xFF
         val &= 0xFF
         self.mem[addr] = val
+        # Drop cached decodes whose opcode or operand byte changed
+        self.decoded[addr] = None
+        self.decoded[(addr - 1) & 0xFF] = None
         if addr == IO_ADDR:
-            sys.stdout.buffer.write(bytes([val]))
-            sys.stdout.buffer.flush()
+            self._io_write(val)
+
+    def _buffer_stdout(self, val):
+        """Default I/O port sink: queue a byte for stdout."""
+        self._outbuf.append(val)
+        if len(self._outbuf) >= IO_FLUSH_SIZE:
+            self.flush_output()
+
+    def flush_output(self):
+        """Write buffered I/O port output to stdout (default sink only).
+
+        run() calls this when it returns; callers driving step() directly
+        must call it themselves.
+        """
+        if self._outbuf:
+            out = sys.stdout.buffer
+            out.write(self._outbuf)
+            out.flush()
+            self._outbuf.clear()
 
     def push(self, val):
         if self.sp >= STACK_DEPTH:
             raise RuntimeError(f"Stack overflow (SP={self.sp})")
-        self.stack[self.sp] = val & 0xFF
+        self.stack_packed = (self.stack_packed << 8) | (val & 0xFF)
         self.sp += 1
 
     def pop(self):
         if self.sp <= 0:
             raise RuntimeError(f"Stack underflow (SP={self.sp})")
         self.sp -= 1
-        return self.stack[self.sp]
-
-    def set_zc(self, result):
-        """Set Z and C flags from a 9-bit result (bit 8 = carry)."""
-        val8 = result & 0xFF
-        self.z = (val8 == 0)
-        self.c = bool(result & 0x100)
-
-    def set_z_only(self, val):
-        """Set Z flag only (INC/DEC)."""
-        self.z = ((val & 0xFF) == 0)
-
-    def set_z_clear_c(self, val):
-        """Set Z flag, clear C (logic ops)."""
-        self.z = ((val & 0xFF) == 0)
-        self.c = False
+        val = self.stack_packed & 0xFF
+        self.stack_packed >>= 8
+        return val
 
     # -------------------------------------------------------------------
-    # Resolve source value based on addressing mode
+    # Execute one instruction
     # -------------------------------------------------------------------
-    def resolve_source(self, mm, r_bit, primary_reg):
-        """Fetch the source value based on addressing mode.
+    def decode(self, addr):
+        """Decode the instruction at addr and store it in the decode cache.
 
-        For register mode, primary_reg determines which two registers
-        the R bit selects from.
+        Only loaded addresses are ever cached, so a cache hit also means
+        the PC is inside loaded memory and step() can skip that check.
         """
-        if mm == 0b00:  # immediate
-            return self.fetch()
-        elif mm == 0b01:  # register
-            src_reg = REG_MODE_MAP[primary_reg][r_bit]
-            return self._get_reg(src_reg)
-        elif mm == 0b10:  # direct
-            addr = self.fetch()
-            return self.mem_read(addr)
-        elif mm == 0b11:  # indexed
-            offset = self.fetch()
-            addr = (self.r[r_bit] + offset) & 0xFF
-            return self.mem_read(addr)
-
-    def resolve_dest(self, mm, r_bit, primary_reg, value):
-        """Write value to the destination based on addressing mode.
-
-        For register mode, primary_reg determines which two registers
-        the R bit selects from. For memory modes, writes to memory.
-        """
-        if mm == 0b00:  # immediate — invalid for ST
-            raise RuntimeError("ST with immediate mode is invalid")
-        elif mm == 0b01:  # register
-            dst_reg = REG_MODE_MAP[primary_reg][r_bit]
-            self._set_reg(dst_reg, value)
-        elif mm == 0b10:  # direct
-            addr = self.fetch()
-            self.mem_write(addr, value)
-        elif mm == 0b11:  # indexed
-            offset = self.fetch()
-            addr = (self.r[r_bit] + offset) & 0xFF
-            self.mem_write(addr, value)
+        if not (self.loaded_mask >> addr) & 1:
+            raise RuntimeError(
+                f"PC entered unloaded memory at address 0x{addr:02X}")
+        opcode = self.mem[addr]
+        length = INSTR_LENGTH[opcode]
+        operand = self.mem[(addr + 1) & 0xFF] if length == 2 else None
+        entry = self.decoded[addr] = (DISPATCH[opcode], opcode, operand,
+                                      length)
+        return entry
 
-    # -------------------------------------------------------------------
-    # Execute one instruction
-    # -------------------------------------------------------------------
     def step(self, trace=False):
         if self.halted:
             return False
 
-        if self.pc not in self.loaded:
-            raise RuntimeError(
-                f"PC entered unloaded memory at address 0x{self.pc:02X}")
-
-        pc_before = self.pc
-        opcode = self.fetch()
-
-        iiiii = (opcode >> 3) & 0x1F
-        r_bit = (opcode >> 2) & 1
-        mm = opcode & 0x03
+        pc = self.pc
+        entry = self.decoded[pc]
+        if entry is None:
+            entry = self.decode(pc)
+        handler, opcode, operand, length = entry
 
         if trace:
-            self._trace(pc_before, opcode)
-
-        # --- LD instructions ---
-        if iiiii in LD_OPCODES:
-            _, primary_reg = LD_OPCODES[iiiii]
-            value = self.resolve_source(mm, r_bit, primary_reg)
-            self._set_reg(primary_reg, value)
-
-        # --- ST instructions ---
-        elif iiiii in ST_OPCODES:
-            _, primary_reg = ST_OPCODES[iiiii]
-            value = self._get_reg(primary_reg)
-            self.resolve_dest(mm, r_bit, primary_reg, value)
-
-        # --- ALU instructions ---
-        elif iiiii in ALU_OPCODES:
-            mnemonic = ALU_OPCODES[iiiii]
-            src = self.resolve_source(mm, r_bit, "A")
-
-            if mnemonic == "ADD":
-                result = self.a + src
-                self.set_zc(result)
-                self.a = result & 0xFF
-
-            elif mnemonic == "SUB":
-                # 6502 convention: C=1 if no borrow (A >= src)
-                self.c = (self.a >= src)
-                self.a = (self.a - src) & 0xFF
-                self.z = (self.a == 0)
-
-            elif mnemonic == "AND":
-                self.a = self.a & src
-                self.set_z_clear_c(self.a)
-
-            elif mnemonic == "OR":
-                self.a = self.a | src
-                self.set_z_clear_c(self.a)
-
-            elif mnemonic == "XOR":
-                self.a = self.a ^ src
-                self.set_z_clear_c(self.a)
-
-            elif mnemonic == "CMP":
-                result = self.a - src
-                self.c = (self.a >= src)
-                self.z = ((result & 0xFF) == 0)
-
-        # --- JMP ---
-        elif opcode == 0x60:
-            addr = self.fetch()
-            self.pc = addr
-
-        # --- Conditional branches ---
-        elif opcode in BRANCH_CONDITION:
-            disp_byte = self.fetch()
-            # Signed displacement
-            disp = disp_byte if disp_byte < 128 else disp_byte - 256
-            _, cond_fn = BRANCH_CONDITION[opcode]
-            if cond_fn(self.z, self.c):
-                self.pc = (self.pc + disp) & 0xFF
-
-        # --- CALL ---
-        elif opcode == 0x70:
-            addr = self.fetch()
-            self.push(self.pc)  # return address (already past operand)
-            self.pc = addr
-
-        # --- RET ---
-        elif opcode == 0x78:
-            self.pc = self.pop()
-
-        # --- PUSH ---
-        elif iiiii == 0b10000:  # PUSH group
-            reg_code = mm  # bits 1-0
-            if reg_code in REG_ENCODING:
-                reg_name = REG_ENCODING[reg_code]
-                self.push(self._get_reg(reg_name))
-            else:
-                raise RuntimeError(
-                    f"Invalid PUSH encoding 0x{opcode:02X} "
-                    f"at address 0x{pc_before:02X}")
-
-        # --- POP ---
-        elif iiiii == 0b10001:  # POP group
-            reg_code = mm  # bits 1-0
-            if reg_code in REG_ENCODING:
-                reg_name = REG_ENCODING[reg_code]
-                self._set_reg(reg_name, self.pop())
-            else:
-                raise RuntimeError(
-                    f"Invalid POP encoding 0x{opcode:02X} "
-                    f"at address 0x{pc_before:02X}")
-
-        # --- INC ---
-        elif iiiii == 0b10010:  # INC group
-            reg_code = mm
-            if reg_code in REG_ENCODING:
-                reg_name = REG_ENCODING[reg_code]
-                val = (self._get_reg(reg_name) + 1) & 0xFF
-                self._set_reg(reg_name, val)
-                self.set_z_only(val)
-            else:
-                raise RuntimeError(
-                    f"Invalid INC encoding 0x{opcode:02X} "
-                    f"at address 0x{pc_before:02X}")
-
-        # --- DEC ---
-        elif iiiii == 0b10011:  # DEC group
-            reg_code = mm
-            if reg_code in REG_ENCODING:
-                reg_name = REG_ENCODING[reg_code]
-                val = (self._get_reg(reg_name) - 1) & 0xFF
-                self._set_reg(reg_name, val)
-                self.set_z_only(val)
-            else:
-                raise RuntimeError(
-                    f"Invalid DEC encoding 0x{opcode:02X} "
-                    f"at address 0x{pc_before:02X}")
+            self._trace(pc, opcode)
 
-        # --- NOP ---
-        elif opcode == 0xA0:
-            pass
-
-        # --- HLT ---
-        elif opcode == 0xA8:
-            self.halted = True
-
-        else:
-            raise RuntimeError(
-                f"Invalid opcode 0x{opcode:02X} "
-                f"at address 0x{pc_before:02X}")
+        self.pc = (pc + length) & 0xFF
+        handler(self, opcode, operand)
 
         self.cycles += 1
         return not self.halted
@@ -434,30 +346,449 @@ class CPU:
         flags += "C" if self.c else "."
         print(
             f"  PC={pc:02X} OP={opcode:02X}  "
-            f"A={self.a:02X} R0={self.r[0]:02X} R1={self.r[1]:02X}  "
+            f"A={self.a:02X} R0={self.r0:02X} R1={self.r1:02X}  "
             f"SP={self.sp} [{flags}]",
-            file=sys.stderr,
+            file=sys.stderr if self.log is None else self.log,
         )
 
+    def _run_fast(self, max_cycles):
+        """Execute until HLT or max_cycles without tracing.
+
+        Same behaviour as calling step() in a loop, but with the lookups
+        step() repeats every cycle hoisted into locals.
+        """
+        decoded = self.decoded
+        decode = self.decode
+        cycles = self.cycles
+        try:
+            while cycles < max_cycles and not self.halted:
+                # The cycle limit is only checked between batches
+                for _ in range(min(RUN_BATCH, max_cycles - cycles)):
+                    pc = self.pc
+                    entry = decoded[pc]
+                    if entry is None:
+                        entry = decode(pc)
+                    handler, opcode, operand, length = entry
+                    self.pc = (pc + length) & 0xFF
+                    handler(self, opcode, operand)
+                    cycles += 1
+                    if self.halted:
+                        break
+        finally:
+            self.cycles = cycles
+
     def run(self, trace=False, max_cycles=65536):
-        while self.cycles < max_cycles:
-            try:
-                if not self.step(trace=trace):
-                    break
-            except RuntimeError as e:
-                print(f"\nRuntime error at cycle {self.cycles}: {e}",
-                      file=sys.stderr)
-                return 1
+        log = sys.stderr if self.log is None else self.log
+        try:
+            if trace:
+                # Flush port output every step so it lines up with the
+                # trace line of the instruction that produced it
+                while self.cycles < max_cycles:
+                    running = self.step(trace=True)
+                    self.flush_output()
+                    if not running:
+                        break
+            else:
+                self._run_fast(max_cycles)
+        except RuntimeError as e:
+            self.flush_output()
+            print(f"\nRuntime error at cycle {self.cycles}: {e}", file=log)
+            return 1
+        finally:
+            self.flush_output()
 
         if self.cycles >= max_cycles:
             print(f"\nExecution stopped: max cycles ({max_cycles}) reached",
-                  file=sys.stderr)
+                  file=log)
             return 1
 
         if trace:
-            print(f"\nHalted after {self.cycles} cycles.", file=sys.stderr)
+            print(f"\nHalted after {self.cycles} cycles.", file=log)
         return 0
 
+# ---------------------------------------------------------------------------
+# Instruction handlers — one per opcode, called as
+# handler(cpu, opcode, operand) with PC already past the instruction
+# ---------------------------------------------------------------------------
+
+# Operand access: one reader/writer per addressing mode, picked when the
+# dispatch table is built so handlers never test MM at run time.
+# Readers are called as read(cpu, operand), writers as
+# write(cpu, operand, value).
+
+def _read_imm(cpu, operand):
+    return operand
+
+
+def _read_a(cpu, operand):
+    return cpu.a
+
+
+def _read_r0(cpu, operand):
+    return cpu.r0
+
+
+def _read_r1(cpu, operand):
+    return cpu.r1
+
+
+def _read_direct(cpu, operand):
+    return cpu.mem[operand]
+
+
+def _read_indexed_r0(cpu, operand):
+    return cpu.mem[(cpu.r0 + operand) & 0xFF]
+
+
+def _read_indexed_r1(cpu, operand):
+    return cpu.mem[(cpu.r1 + operand) & 0xFF]
+
+
+def _write_imm(cpu, operand, value):
+    raise RuntimeError("ST with immediate mode is invalid")
+
+
+def _write_a(cpu, operand, value):
+    cpu.a = value
+
+
+def _write_r0(cpu, operand, value):
+    cpu.r0 = value
+
+
+def _write_r1(cpu, operand, value):
+    cpu.r1 = value
+
+
+def _write_direct(cpu, operand, value):
+    cpu.mem_write(operand, value)
+
+
+def _write_indexed_r0(cpu, operand, value):
+    cpu.mem_write((cpu.r0 + operand) & 0xFF, value)
+
+
+def _write_indexed_r1(cpu, operand, value):
+    cpu.mem_write((cpu.r1 + operand) & 0xFF, value)
+
+
+# Register-mode operand access by register name
+REG_READERS = {"A": _read_a, "R0": _read_r0, "R1": _read_r1}
+REG_WRITERS = {"A": _write_a, "R0": _write_r0, "R1": _write_r1}
+
+
+def _source_reader(mm, r_bit, primary_reg):
+    """Return the operand reader for an addressing mode.
+
+    For register mode, primary_reg determines which two registers
+    the R bit selects from.
+    """
+    if mm == 0b00:  # immediate
+        return _read_imm
+    if mm == 0b01:  # register
+        return REG_READERS[REG_MODE_MAP[primary_reg][r_bit]]
+    if mm == 0b10:  # direct
+        return _read_direct
+    return _read_indexed_r1 if r_bit else _read_indexed_r0  # indexed
+
+
+def _dest_writer(mm, r_bit, primary_reg):
+    """Return the operand writer for an addressing mode (ST)."""
+    if mm == 0b00:  # immediate — invalid for ST
+        return _write_imm
+    if mm == 0b01:  # register
+        return REG_WRITERS[REG_MODE_MAP[primary_reg][r_bit]]
+    if mm == 0b10:  # direct
+        return _write_direct
+    return _write_indexed_r1 if r_bit else _write_indexed_r0  # indexed
+
+
+def _make_ld_a(read):
+    def _do_ld_a(cpu, opcode, operand):
+        cpu.a = read(cpu, operand)
+    return _do_ld_a
+
+
+def _make_ld_r0(read):
+    def _do_ld_r0(cpu, opcode, operand):
+        cpu.r0 = read(cpu, operand)
+    return _do_ld_r0
+
+
+def _make_ld_r1(read):
+    def _do_ld_r1(cpu, opcode, operand):
+        cpu.r1 = read(cpu, operand)
+    return _do_ld_r1
+
+
+def _make_st_a(write):
+    def _do_st_a(cpu, opcode, operand):
+        write(cpu, operand, cpu.a)
+    return _do_st_a
+
+
+def _make_st_r0(write):
+    def _do_st_r0(cpu, opcode, operand):
+        write(cpu, operand, cpu.r0)
+    return _do_st_r0
+
+
+def _make_st_r1(write):
+    def _do_st_r1(cpu, opcode, operand):
+        write(cpu, operand, cpu.r1)
+    return _do_st_r1
+
+
+# Primary register -> LD / ST handler factory
+LD_FACTORIES = {"A": _make_ld_a, "R0": _make_ld_r0, "R1": _make_ld_r1}
+ST_FACTORIES = {"A": _make_st_a, "R0": _make_st_r0, "R1": _make_st_r1}
+
+
+def _alu_add(cpu, src):
+    result = cpu.a + src
+    cpu.a = result & 0xFF
+    cpu.z = (cpu.a == 0)
+    cpu.c = result > 0xFF
+
+
+def _alu_sub(cpu, src):
+    # 6502 convention: C=1 if no borrow (A >= src)
+    cpu.c = (cpu.a >= src)
+    cpu.a = (cpu.a - src) & 0xFF
+    cpu.z = (cpu.a == 0)
+
+
+def _alu_and(cpu, src):
+    cpu.a = cpu.a & src
+    cpu.z = (cpu.a == 0)
+    cpu.c = False
+
+
+def _alu_or(cpu, src):
+    cpu.a = cpu.a | src
+    cpu.z = (cpu.a == 0)
+    cpu.c = False
+
+
+def _alu_xor(cpu, src):
+    cpu.a = cpu.a ^ src
+    cpu.z = (cpu.a == 0)
+    cpu.c = False
+
+
+def _alu_cmp(cpu, src):
+    result = cpu.a - src
+    cpu.c = (cpu.a >= src)
+    cpu.z = ((result & 0xFF) == 0)
+
+
+# ALU mnemonic -> operation, called as op(cpu, src)
+ALU_HANDLERS = {
+    "ADD": _alu_add,
+    "SUB": _alu_sub,
+    "AND": _alu_and,
+    "OR":  _alu_or,
+    "XOR": _alu_xor,
+    "CMP": _alu_cmp,
+}
+
+
+def _make_alu(alu_op, read):
+    def _do_alu(cpu, opcode, operand):
+        alu_op(cpu, read(cpu, operand))
+    return _do_alu
+
+
+def _do_jmp(cpu, opcode, operand):
+    cpu.pc = operand
+
+
+# Conditional branches: operand is a signed displacement from the next
+# instruction. PC arithmetic wraps at 256, so adding the raw byte gives
+# the same result as adding its sign-extended value.
+
+def _do_bz(cpu, opcode, operand):
+    if cpu.z:
+        cpu.pc = (cpu.pc + operand) & 0xFF
+
+
+def _do_bnz(cpu, opcode, operand):
+    if not cpu.z:
+        cpu.pc = (cpu.pc + operand) & 0xFF
+
+
+def _do_bc(cpu, opcode, operand):
+    if cpu.c:
+        cpu.pc = (cpu.pc + operand) & 0xFF
+
+
+def _do_bnc(cpu, opcode, operand):
+    if not cpu.c:
+        cpu.pc = (cpu.pc + operand) & 0xFF
+
+
+# Branch mnemonic -> handler
+BRANCH_HANDLERS = {
+    "BZ":  _do_bz,
+    "BNZ": _do_bnz,
+    "BC":  _do_bc,
+    "BNC": _do_bnc,
+}
+
+
+def _do_call(cpu, opcode, operand):
+    cpu.push(cpu.pc)  # return address (already past operand)
+    cpu.pc = operand
+
+
+def _do_ret(cpu, opcode, operand):
+    cpu.pc = cpu.pop()
+
+
+def _do_push_a(cpu, opcode, operand):
+    cpu.push(cpu.a)
+
+
+def _do_push_r0(cpu, opcode, operand):
+    cpu.push(cpu.r0)
+
+
+def _do_push_r1(cpu, opcode, operand):
+    cpu.push(cpu.r1)
+
+
+def _do_pop_a(cpu, opcode, operand):
+    cpu.a = cpu.pop()
+
+
+def _do_pop_r0(cpu, opcode, operand):
+    cpu.r0 = cpu.pop()
+
+
+def _do_pop_r1(cpu, opcode, operand):
+    cpu.r1 = cpu.pop()
+
+
+def _do_inc_a(cpu, opcode, operand):
+    cpu.a = val = (cpu.a + 1) & 0xFF
+    cpu.z = (val == 0)
+
+
+def _do_inc_r0(cpu, opcode, operand):
+    cpu.r0 = val = (cpu.r0 + 1) & 0xFF
+    cpu.z = (val == 0)
+
+
+def _do_inc_r1(cpu, opcode, operand):
+    cpu.r1 = val = (cpu.r1 + 1) & 0xFF
+    cpu.z = (val == 0)
+
+
+def _do_dec_a(cpu, opcode, operand):
+    cpu.a = val = (cpu.a - 1) & 0xFF
+    cpu.z = (val == 0)
+
+
+def _do_dec_r0(cpu, opcode, operand):
+    cpu.r0 = val = (cpu.r0 - 1) & 0xFF
+    cpu.z = (val == 0)
+
+
+def _do_dec_r1(cpu, opcode, operand):
+    cpu.r1 = val = (cpu.r1 - 1) & 0xFF
+    cpu.z = (val == 0)
+
+
+def _make_bad_encoding(group):
+    def _do_bad_encoding(cpu, opcode, operand):
+        raise RuntimeError(
+            f"Invalid {group} encoding 0x{opcode:02X} "
+            f"at address 0x{(cpu.pc - 1) & 0xFF:02X}")
+    return _do_bad_encoding
+
+
+def _do_nop(cpu, opcode, operand):
+    pass
+
+
+def _do_hlt(cpu, opcode, operand):
+    cpu.halted = True
+
+
+def _do_invalid(cpu, opcode, operand):
+    raise RuntimeError(
+        f"Invalid opcode 0x{opcode:02X} "
+        f"at address 0x{(cpu.pc - 1) & 0xFF:02X}")
+
+
+# PUSH/POP/INC/DEC IIIII codes -> (group name, {register: handler})
+_REG_GROUPS = {
+    0b10000: ("PUSH", {"A": _do_push_a, "R0": _do_push_r0,
+                       "R1": _do_push_r1}),
+    0b10001: ("POP",  {"A": _do_pop_a, "R0": _do_pop_r0,
+                       "R1": _do_pop_r1}),
+    0b10010: ("INC",  {"A": _do_inc_a, "R0": _do_inc_r0,
+                       "R1": _do_inc_r1}),
+    0b10011: ("DEC",  {"A": _do_dec_a, "R0": _do_dec_r0,
+                       "R1": _do_dec_r1}),
+}
+REG_GROUP_TABLE = tuple(_REG_GROUPS.get(i) for i in range(32))
+
+
+def _build_dispatch():
+    """Decode every opcode once.
+
+    Returns (handlers, lengths): 256-entry tuples giving each opcode's
+    handler and its instruction length in bytes.
+    """
+    table = [_do_invalid] * 256
+    lengths = [1] * 256
+    for opcode in range(256):
+        iiiii = (opcode >> 3) & 0x1F
+        r_bit = (opcode >> 2) & 1
+        mm = opcode & 0x03
+        ld, st, alu = LD_TABLE[iiiii], ST_TABLE[iiiii], ALU_TABLE[iiiii]
+        reg_group = REG_GROUP_TABLE[iiiii]
+        if ld is not None:
+            primary_reg = ld[1]
+            read = _source_reader(mm, r_bit, primary_reg)
+            table[opcode] = LD_FACTORIES[primary_reg](read)
+            lengths[opcode] = 1 if mm == 0b01 else 2
+        elif st is not None:
+            primary_reg = st[1]
+            write = _dest_writer(mm, r_bit, primary_reg)
+            table[opcode] = ST_FACTORIES[primary_reg](write)
+            # ST immediate faults before reading an operand
+            lengths[opcode] = 1 if mm in (0b00, 0b01) else 2
+        elif alu is not None:
+            read = _source_reader(mm, r_bit, "A")
+            table[opcode] = _make_alu(ALU_HANDLERS[alu], read)
+            lengths[opcode] = 1 if mm == 0b01 else 2
+        elif reg_group is not None:
+            # Register in bits 1-0; the R bit is ignored
+            group, handlers = reg_group
+            reg_name = REG_TABLE[mm]
+            if reg_name is not None:
+                table[opcode] = handlers[reg_name]
+            else:
+                table[opcode] = _make_bad_encoding(group)
+        elif BRANCH_TABLE[opcode] is not None:
+            table[opcode] = BRANCH_HANDLERS[BRANCH_TABLE[opcode]]
+            lengths[opcode] = 2
+
+    table[0x60] = _do_jmp
+    lengths[0x60] = 2
+    table[0x70] = _do_call
+    lengths[0x70] = 2
+    table[0x78] = _do_ret
+    table[0xA0] = _do_nop
+    table[0xA8] = _do_hlt
+    return tuple(table), tuple(lengths)
+
+
+DISPATCH, INSTR_LENGTH = _build_dispatch()
+
+
 # ---------------------------------------------------------------------------
 # CLI
 # ---------------------------------------------------------------------------
@@ -484,7 +815,7 @@ def detect_format(path, data):
 
 
 def parse_file(path):
-    """Read and parse a file, returning its address map."""
+    """Read and parse a file, returning its (image, mask) pair."""
     with open(path, "rb") as f:
         data = f.read()
     fmt = detect_format(path, data)
@@ -496,29 +827,27 @@ def parse_file(path):
         return parse_bin(data)
 
 
-def check_overlaps(file_maps):
+def check_overlaps(file_masks):
     """Check for address overlaps between files.
 
-    file_maps: list of (path, addr_map) tuples.
+    file_masks: list of (path, mask) tuples.
     Returns a list of error strings, empty if no overlaps.
     """
-    # For each address, track which file(s) wrote to it
-    addr_owners = {}  # addr -> list of filenames
-    for path, addr_map in file_maps:
-        for addr in addr_map:
-            addr_owners.setdefault(addr, []).append(path)
+    # OR the masks together, collecting any bit that was already set
+    seen = overlap = 0
+    for _, mask in file_masks:
+        overlap |= seen & mask
+        seen |= mask
 
     errors = []
-    # Collect addresses that appear in more than one file
-    conflicts = {a: owners for a, owners in addr_owners.items()
-                 if len(owners) > 1}
-    if not conflicts:
+    if not overlap:
         return errors
 
     # Group by the same pair/set of conflicting files for a compact message
     groups = {}  # frozenset of filenames -> sorted list of addresses
-    for addr in sorted(conflicts):
-        key = frozenset(conflicts[addr])
+    for addr in _mask_addrs(overlap):
+        key = frozenset(path for path, mask in file_masks
+                        if (mask >> addr) & 1)
         groups.setdefault(key, []).append(addr)
 
     for files, addrs in groups.items():
@@ -534,6 +863,10 @@ def check_overlaps(file_maps):
 
 
 def main():
+    # Imported here so importing the simulator as a library (e.g. from the
+    # web server) does not pay for argparse
+    import argparse
+
     parser = argparse.ArgumentParser(description="EDU-CPU Simulator")
     parser.add_argument("programs", nargs="+",
                         help="Program files to load (.bin, .hex, or .srec)")
@@ -544,7 +877,7 @@ def main():
     args = parser.parse_args()
 
     # Parse all files
-    file_maps = []
+    images = []
     for path in args.programs:
         fmt = detect_format(path, b"")
         if len(args.programs) > 1 and fmt == "bin":
@@ -552,11 +885,12 @@ def main():
                   f"when loading multiple files — use .hex or .srec",
                   file=sys.stderr)
             sys.exit(1)
-        file_maps.append((path, parse_file(path)))
+        images.append((path, parse_file(path)))
 
     # Check for overlaps between files
-    if len(file_maps) > 1:
-        errors = check_overlaps(file_maps)
+    if len(images) > 1:
+        errors = check_overlaps(
+            [(path, mask) for path, (_, mask) in images])
         if errors:
             for err in errors:
                 print(f"ERROR: {err}", file=sys.stderr)
@@ -564,8 +898,8 @@ def main():
 
     # Load all into CPU
     cpu = CPU()
-    for _, addr_map in file_maps:
-        cpu.load_map(addr_map)
+    for _, (image, mask) in images:
+        cpu.load_map(image, mask)
 
     rc = cpu.run(trace=args.trace, max_cycles=args.max_cycles)
     sys.exit(rc)
@@ -4,12 +4,13 @@
 import sys
 import os
 import io
+import queue
 
 from flask import Flask, request, jsonify, render_template
 
 # Import assembler and simulator from parent directory
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
-from assembler import Assembler, generate_lst  # noqa: E402
+from assembler import Assembler, generate_lst, used_mask  # noqa: E402
 from simulator import CPU, parse_hex  # noqa: E402
 
 app = Flask(__name__)
@@ -26,27 +27,37 @@ FLAG_HEX_PATH = os.environ.get("FLAG_HEX", FLAG_HEX_DEFAULT)
 MAX_CODE_LEN = 4096
 MAX_CYCLES = 10000
 
-# Load flag data once at startup
+# Load flag data once at startup as a 256-byte image and address mask
 with open(FLAG_HEX_PATH) as f:
-    FLAG_MAP = parse_hex(f.read())
+    FLAG_BYTES, FLAG_MASK = parse_hex(f.read())
 
 # ---------------------------------------------------------------------------
 # Helpers
 # ---------------------------------------------------------------------------
 
+# Idle (cpu, out_buf, log) triples, shared by all request threads
+_pool = queue.SimpleQueue()
 
-class _StdoutCapture:
-    """Drop-in replacement for sys.stdout that captures I/O port writes."""
 
-    def __init__(self):
-        self.buffer = io.BytesIO()
+def _acquire_cpu():
+    """Take an idle CPU and its output sinks from the pool, reset for a new run."""
+    try:
+        state = _pool.get_nowait()
+    except queue.Empty:
+        out_buf = bytearray()
+        log = io.StringIO()
+        return CPU(io_write=out_buf.append, log=log), out_buf, log
+    cpu, out_buf, log = state
+    cpu.reset()
+    out_buf.clear()
+    log.seek(0)
+    log.truncate()
+    return state
 
-    def write(self, s):
-        # text writes (e.g. accidental print()) are silently dropped
-        pass
 
-    def flush(self):
-        pass
+def _release_cpu(state):
+    """Return a CPU taken with _acquire_cpu() to the pool."""
+    _pool.put(state)
 
 
 def _adjust_line(msg):
@@ -89,7 +100,7 @@ def api_run():
 
     # Assemble
     asm = Assembler()
-    output, listing = asm.assemble(code)
+    output, used, listing = asm.assemble(code)
 
     if asm.errors:
         errors = [_adjust_line(str(e)) for e in asm.errors]
@@ -99,31 +110,26 @@ def api_run():
 
     lst_text = generate_lst(listing) if listing else ""
 
-    # Create CPU, load user code first, then flag data
-    cpu = CPU()
-    cpu.load_map(output)
-    cpu.load_map(FLAG_MAP)
-
-    # Run with captured I/O
-    cap_out = _StdoutCapture()
-    cap_err = io.StringIO()
-    saved_out, saved_err = sys.stdout, sys.stderr
+    # Take a pooled CPU, load user code first, then flag data
+    state = _acquire_cpu()
+    cpu, out_buf, log = state
     try:
-        sys.stdout = cap_out
-        sys.stderr = cap_err
+        cpu.load_map(output, used_mask(used))
+        cpu.load_map(FLAG_BYTES, FLAG_MASK)
+
         exit_code = cpu.run(trace=trace, max_cycles=MAX_CYCLES)
+
+        return jsonify(
+            success=True,
+            errors=[],
+            listing=lst_text,
+            stdout=out_buf.decode("latin-1"),
+            stderr=log.getvalue(),
+            exit_code=exit_code,
+            cycles=cpu.cycles,
+        )
     finally:
-        sys.stdout, sys.stderr = saved_out, saved_err
-
-    return jsonify(
-        success=True,
-        errors=[],
-        listing=lst_text,
-        stdout=cap_out.buffer.getvalue().decode("latin-1"),
-        stderr=cap_err.getvalue(),
-        exit_code=exit_code,
-        cycles=cpu.cycles,
-    )
+        _release_cpu(state)
 
 
 # ---------------------------------------------------------------------------